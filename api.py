@@ -1,12 +1,21 @@
 import os
+import re
+import asyncio
+import collections
+import threading
+import time
+import unicodedata
 import uvicorn
-import requests
+import httpx
 import json 
+import numpy as np
+import orjson
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from pinecone import Pinecone
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, BadRequestError, DefaultHttpxClient, DefaultAsyncHttpxClient
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 # Librerías necesarias para SendGrid API
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
@@ -16,6 +25,16 @@ INDEX_NAME = "sf-abogados-01"
 EMBEDDING_MODEL = "text-embedding-ada-002"
 GENERATION_MODEL = "gpt-4o-mini" # Modelo Correcto
 TOP_K = 5
+SUMMARY_START_TAG = "[INTERNAL_SUMMARY_START]"
+SUMMARY_END_TAG = "[INTERNAL_SUMMARY_END]"
+
+# --- CACHÉ SEMÁNTICA DE CONTEXTO ---
+SEMANTIC_CACHE_THRESHOLD = 0.95 # Similitud coseno mínima para reutilizar un contexto
+SEMANTIC_CACHE_MAX_ENTRIES = 5_000 # Cada entrada guarda los textos de TOP_K chunks (~5-10 KB)
+SEMANTIC_CACHE_TTL_SECONDS = 6 * 3600 # Tras una reindexación, el contexto viejo deja de servirse a más tardar en este plazo
+SEMANTIC_CACHE_QUANTIZE_MIN = 1_000 # Por debajo de este tamaño FP32 ya es barato
+EMBEDDING_CACHE_MAX_ENTRIES = 10_000 # Embeddings de preguntas normalizadas (LRU)
+EMBEDDING_BATCH_WINDOW = 0.02 # Segundos que se agrupan las preguntas concurrentes en una sola llamada de embeddings
 
 # --- CONTACTOS Y DETALLES DE VENTA ---
 PHONE_NUMBER = "+593 98 375 6678"
@@ -23,6 +42,44 @@ SALES_EMAIL = "leads@abogados-sf.com"
 CONSULTATION_COST = "40 USD"
 CONSULTATION_CREDIT_MESSAGE = f"Recuerda que este monto, en caso de que llevemos contigo el caso, **se acredita al costo total del servicio como descuento**."
 
+# --- DESPACHO LOCAL DE CONSULTAS FUERA DE ESPECIALIDAD (SIN OPENAI NI PINECONE) ---
+# Solo términos inequívocos: "fiscalía", "denuncia" o "impuestos" aparecen en casos de familia y sucesiones
+OUT_OF_SCOPE_KEYWORDS = (
+    "despido", "despidieron", "laboral", "finiquito", "ministerio del trabajo", "mercantil", "aduana", "aduanero",
+)
+IN_SCOPE_KEYWORDS = (
+    "familia", "familiar", "intrafamiliar", "violencia", "agresion", "agrede", "maltrato", "boleta de auxilio",
+    "divorcio", "matrimonio", "casado", "casada", "union de hecho", "esposo", "esposa", "pareja", "conviviente",
+    "alimentos", "pension", "custodia", "tenencia", "visitas", "regimen de visitas", "paternidad",
+    "padre", "madre", "papa", "mama", "hijo", "hija", "hijos", "hijas", "menor", "menores", "nino", "nina",
+    "herencia", "heredero", "herederos", "testamento", "sucesion", "posesion efectiva", "fallecio",
+    "arriendo", "arrendamiento", "inquilino", "desalojo", "contrato", "propiedad", "escritura", "terreno",
+    "vivienda", "casa", "departamento", "deuda", "civil", "constitucional", "accion de proteccion", "habeas",
+)
+OUT_OF_SCOPE_RESPONSE = (
+    "Lamentablemente, ese asunto está fuera de nuestra especialidad. Si lo desea, puede contactarnos "
+    f"directamente al {PHONE_NUMBER} para ver si podemos recomendarle un colega."
+)
+
+def _compile_keywords(keywords):
+    return re.compile(r"\b(?:" + "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True)) + r")\b")
+
+OUT_OF_SCOPE_PATTERN = _compile_keywords(OUT_OF_SCOPE_KEYWORDS)
+IN_SCOPE_PATTERN = _compile_keywords(IN_SCOPE_KEYWORDS)
+
+def dispatch_out_of_scope(question: str, history: list[dict]):
+    """
+    Aplica la Regla de Cierre de Contraste sin pasar por el pipeline RAG.
+    Solo en el primer mensaje (sin historial) y si la pregunta menciona una rama ajena
+    sin ninguna palabra de nuestra especialidad. Devuelve la respuesta fija o None.
+    """
+    if history:
+        return None
+    normalized = unicodedata.normalize('NFKD', question.lower()).encode('ascii', 'ignore').decode('ascii')
+    if OUT_OF_SCOPE_PATTERN.search(normalized) and not IN_SCOPE_PATTERN.search(normalized):
+        return OUT_OF_SCOPE_RESPONSE
+    return None
+
 # --- MODELO DE DATOS DE ENTRADA (INCLUYE MEMORIA DE CHAT) ---
 class QueryModel(BaseModel):
     """Define la estructura de la solicitud JSON que recibirá el API."""
@@ -30,6 +87,10 @@ class QueryModel(BaseModel):
     recaptcha_token: str
     history: list[dict] = [] # ACEPTA EL HISTORIAL
 
+class AnswerModel(BaseModel):
+    """Respuesta de /query. Con el tipo de retorno declarado, Pydantic la serializa directamente a JSON."""
+    answer: str
+
 # --- INICIALIZACIÓN DE FASTAPI Y CORS ---
 
 app = FastAPI(title="Asistente Legal SF API (RAG con GPT-4o Mini)")
@@ -44,6 +105,7 @@ app.add_middleware(
 # --- INICIALIZACIÓN DE CLIENTES ---
 pc = None
 openai_client = None
+async_openai_client = None
 pinecone_index = None
 SENDGRID_API_KEY = None 
 
@@ -68,7 +130,14 @@ try:
 
     # Inicialización de clientes
     pc = Pinecone(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    # Cliente HTTP compartido (reCAPTCHA y OpenAI asíncrono): un solo pool de conexiones persistentes
+    # HTTP/2 en lugar de un handshake TLS por solicitud
+    http_client = DefaultAsyncHttpxClient(
+        http2=True, timeout=30, limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=DefaultHttpxClient(http2=True))
+    # Cliente asíncrono para la recuperación: el embedding de la pregunta no bloquea el event loop
+    async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
     pinecone_index = pc.Index(INDEX_NAME)
 
 except Exception as e:
@@ -136,7 +205,7 @@ async def validate_recaptcha(token: str, min_score: float = 0.5):
     if token == 'EsteEsUnTokenDePruebaTemporal':
         return True
 
-    response = requests.post(
+    response = await http_client.post(
         'https://www.google.com/recaptcha/api/siteverify',
         data={'secret': RECAPTCHA_SECRET_KEY, 'response': token}
     )
@@ -146,22 +215,221 @@ async def validate_recaptcha(token: str, min_score: float = 0.5):
     else:
         return False
 
+# --- CACHÉ SEMÁNTICA (EMBEDDINGS CUANTIZADOS A INT8) ---
+def quantize_int8(vector):
+    """Cuantización simétrica por vector. Devuelve el vector int8 y su escala."""
+    max_abs = float(np.max(np.abs(vector)))
+    scale = max_abs / 127 if max_abs else 1.0
+    return np.round(vector / scale).astype(np.int8), np.float32(scale)
+
+
+class SemanticCache:
+    """
+    Caché en memoria que reutiliza el contexto de Pinecone para preguntas casi idénticas.
+    Con pocas entradas guarda los embeddings en FP32; al superar `quantize_min` pasa a
+    int8 con una escala por vector (4 veces menos memoria). Es solo un ahorro de memoria:
+    numpy no tiene BLAS para int8 y el producto es más lento que en FP32 (~60 ms frente a
+    ~40 ms con 100k x 1536), así que lookup/add se llaman fuera del event loop y se serializan con un lock.
+    Las entradas con más de `ttl` segundos se ignoran, para no servir contexto de un índice anterior.
+    """
+
+    def __init__(self, threshold: float, max_entries: int, quantize_min: int, ttl: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.quantize_min = quantize_min
+        self.ttl = ttl
+        self._fp32 = None
+        self._int8 = None
+        self._scales = None
+        self._times = None # Momento (time.monotonic) en que se guardó cada entrada
+        self._values = []
+        self._next = 0 # Posición de escritura (buffer circular al llenarse)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _grow(self, dim: int):
+        """Duplica la capacidad de los arreglos (hasta `max_entries`) cuando se llenan."""
+        storage = self._int8 if self._int8 is not None else self._fp32
+        capacity = 0 if storage is None else storage.shape[0]
+        if len(self._values) < capacity or capacity >= self.max_entries:
+            return
+
+        new_capacity = min(max(capacity * 2, 64), self.max_entries)
+        grown = np.empty((new_capacity, dim), dtype=np.int8 if self._int8 is not None else np.float32)
+        if storage is not None:
+            grown[:capacity] = storage
+        times = np.zeros(new_capacity)
+        if self._times is not None:
+            times[:capacity] = self._times
+        self._times = times
+
+        if self._int8 is not None:
+            scales = np.ones(new_capacity, dtype=np.float32)
+            scales[:capacity] = self._scales
+            self._int8, self._scales = grown, scales
+        else:
+            self._fp32 = grown
+
+    def _quantize_all(self):
+        rows = self._fp32[:len(self._values)]
+        max_abs = np.max(np.abs(rows), axis=1)
+        scales = np.where(max_abs > 0, max_abs / 127, 1.0).astype(np.float32)
+        self._int8 = np.empty(self._fp32.shape, dtype=np.int8)
+        self._int8[:len(rows)] = np.round(rows / scales[:, None])
+        self._scales = np.ones(self._fp32.shape[0], dtype=np.float32)
+        self._scales[:len(rows)] = scales
+        self._fp32 = None
+
+    def lookup(self, embedding):
+        """Devuelve el valor cacheado más similar si supera el umbral, o None."""
+        with self._lock:
+            return self._lookup(embedding)
+
+    def _lookup(self, embedding):
+        count = len(self._values)
+        if count == 0:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        fresh = self._times[:count] >= time.monotonic() - self.ttl
+        if not fresh.any():
+            return None
+
+        if self._int8 is None:
+            scores = np.where(fresh, self._fp32[:count] @ query, -np.inf)
+            best = int(np.argmax(scores))
+            score = float(scores[best]) / (float(np.linalg.norm(self._fp32[best]) * np.linalg.norm(query)) or 1.0)
+        else:
+            # Búsqueda aproximada en int8 (acumulando en int32) y refinamiento FP32 del mejor candidato
+            query_int8, _ = quantize_int8(query)
+            raw_scores = np.einsum("ij,j->i", self._int8[:count], query_int8, dtype=np.int32, casting="safe")
+            best = int(np.argmax(np.where(fresh, raw_scores * self._scales[:count], -np.inf)))
+            candidate = self._int8[best].astype(np.float32) * self._scales[best]
+            score = float(candidate @ query) / (float(np.linalg.norm(candidate) * np.linalg.norm(query)) or 1.0)
+
+        return self._values[best] if score >= self.threshold else None
+
+    def add(self, embedding, value):
+        """Inserta un embedding y su valor; al llenarse sobrescribe la entrada más antigua."""
+        with self._lock:
+            self._add(embedding, value)
+
+    def _add(self, embedding, value):
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._grow(vector.shape[0])
+
+        if len(self._values) < self.max_entries:
+            position = len(self._values)
+            self._values.append(value)
+        else:
+            position = self._next
+            self._values[position] = value
+        self._next = (position + 1) % self.max_entries
+        self._times[position] = time.monotonic()
+
+        if self._int8 is not None:
+            self._int8[position], self._scales[position] = quantize_int8(vector)
+        else:
+            self._fp32[position] = vector
+            if len(self._values) > self.quantize_min:
+                self._quantize_all()
+
+
+context_cache = SemanticCache(
+    SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_QUANTIZE_MIN, SEMANTIC_CACHE_TTL_SECONDS
+)
+
 # --- LÓGICA RAG Y EMBEDDINGS (SIN CAMBIOS) ---
-def generate_embedding(text):
-    response = openai_client.embeddings.create(input=[text], model=EMBEDDING_MODEL)
-    return response.data[0].embedding
+def normalize_query(text):
+    """Minúsculas y espacios colapsados: preguntas repetidas con otro formato comparten entrada en la caché."""
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+class EmbeddingBatcher:
+    """
+    Micro-batching de embeddings: las preguntas que llegan dentro de una ventana de `window`
+    segundos se envían juntas en una sola llamada (mismo costo por token, un solo round-trip).
+    Preguntas idénticas dentro de la misma ventana comparten resultado. Si OpenAI rechaza el lote
+    (400), se reintenta pregunta por pregunta para que el error quede solo en la solicitud que lo causó.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._pending = {} # Texto -> future con su embedding
+        self._flush_task = None
+
+    async def embed(self, text):
+        if not text:
+            raise ValueError("La pregunta está vacía.")
+        future = self._pending.get(text)
+        if future is None:
+            future = self._pending[text] = asyncio.get_running_loop().create_future()
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush())
+        # shield: si una solicitud se cancela, las demás que esperan el mismo texto siguen recibiéndolo
+        return await asyncio.shield(future)
+
+    async def _flush(self):
+        await asyncio.sleep(self.window)
+        batch, self._pending, self._flush_task = self._pending, {}, None
+        await self._embed_batch(batch)
+
+    async def _embed_batch(self, batch: dict):
+        texts = list(batch)
+        try:
+            response = await async_openai_client.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+        except Exception as e:
+            if isinstance(e, BadRequestError) and len(batch) > 1:
+                # Una pregunta inválida (p. ej. demasiado larga) no debe hacer fallar al resto de la ventana
+                await asyncio.gather(*(self._embed_batch({text: future}) for text, future in batch.items()))
+                return
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for item in response.data:
+            batch[texts[item.index]].set_result(item.embedding)
+
+
+embedding_batcher = EmbeddingBatcher(EMBEDDING_BATCH_WINDOW)
+embedding_cache = collections.OrderedDict()
+
+async def generate_embedding(text):
+    """Embedding de la pregunta, con caché LRU en memoria de EMBEDDING_CACHE_MAX_ENTRIES entradas."""
+    embedding = embedding_cache.get(text)
+    if embedding is not None:
+        embedding_cache.move_to_end(text)
+        return embedding
+
+    embedding = embedding_cache[text] = await embedding_batcher.embed(text)
+    if len(embedding_cache) > EMBEDDING_CACHE_MAX_ENTRIES:
+        embedding_cache.popitem(last=False)
+    return embedding
 
 def retrieve_context(embedding):
+    """Consulta Pinecone y devuelve solo los textos de los chunks (lo único que usa el prompt y lo que se cachea)."""
     query_results = pinecone_index.query(
         vector=embedding,
         top_k=TOP_K,
         include_metadata=True
     )
+    return tuple(match['metadata']['text'] for match in query_results.matches)
+
+async def get_query_context(question):
+    """
+    Obtiene el contexto RAG de la pregunta, reutilizando la caché semántica si es posible.
+    Es asíncrona (la consulta a Pinecone corre en un hilo), así que varias preguntas pueden
+    recuperarse en paralelo con asyncio.gather.
+    """
+    query_embedding = await generate_embedding(normalize_query(question))
+    query_results = await asyncio.to_thread(context_cache.lookup, query_embedding)
+    if query_results is None:
+        query_results = await asyncio.to_thread(retrieve_context, query_embedding)
+        await asyncio.to_thread(context_cache.add, query_embedding, query_results)
     return query_results
 
-def generate_final_response(query, context, history):
+def build_messages(query, context, history):
     """
-    Genera la respuesta final utilizando el contexto, la memoria (history)
+    Construye la matriz de mensajes a partir del contexto, la memoria (history)
     y el Super Prompt final.
     """
     # --- SUPER PROMPT COMPLETO (VERSIÓN 3.0) ---
@@ -202,7 +470,7 @@ def generate_final_response(query, context, history):
     )
 
     # 3. Formatear el Contexto RAG y la Pregunta
-    context_text = "\n\n".join([item['metadata']['text'] for item in context.matches])
+    context_text = "\n\n".join(context)
 
     rag_prompt = (
         f"CONTEXTO PROPORCIONADO PARA EL ANÁLISIS (RAG):\n{context_text}\n\n"
@@ -220,9 +488,13 @@ def generate_final_response(query, context, history):
     # Añadir el prompt RAG (Contexto + Pregunta actual)
     messages.append({"role": "user", "content": rag_prompt})
 
+    return messages
+
+def generate_final_response(query, context, history):
+    """Genera la respuesta final completa (sin streaming)."""
     response = openai_client.chat.completions.create(
         model=GENERATION_MODEL,
-        messages=messages,
+        messages=build_messages(query, context, history),
         temperature=0.0 
     )
 
@@ -230,30 +502,106 @@ def generate_final_response(query, context, history):
 
     return final_response_text
 
+def stream_final_response(query, context, history):
+    """Genera la respuesta final token a token (streaming de OpenAI)."""
+    stream = openai_client.chat.completions.create(
+        model=GENERATION_MODEL,
+        messages=build_messages(query, context, history),
+        temperature=0.0,
+        stream=True
+    )
+
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# --- FILTRO DEL RESUMEN INTERNO EN STREAMING ---
+class SummaryStreamFilter:
+    """
+    Separa en vivo el bloque [INTERNAL_SUMMARY_START]...[INTERNAL_SUMMARY_END] del texto visible.
+    Retiene al final del buffer cualquier prefijo parcial de una etiqueta, para que el
+    usuario nunca vea las etiquetas aunque lleguen partidas entre varios tokens.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_summary = False
+        self._summary_parts = [] # Bloque de resumen en curso (aún sin etiqueta de cierre)
+        self._closed_summaries = []
+
+    @property
+    def summary(self):
+        """Solo los resúmenes con etiqueta de cierre: uno cortado a la mitad nunca se envía."""
+        return "".join(self._closed_summaries).strip()
+
+    def _emit(self, text, visible):
+        (self._summary_parts if self._in_summary else visible).append(text)
+
+    def feed(self, text):
+        """Procesa un fragmento y devuelve la parte que puede mostrarse al usuario."""
+        self._buffer += text
+        visible = []
+
+        while True:
+            tag = SUMMARY_END_TAG if self._in_summary else SUMMARY_START_TAG
+            index = self._buffer.find(tag)
+            if index == -1:
+                break
+            self._emit(self._buffer[:index], visible)
+            self._buffer = self._buffer[index + len(tag):]
+            if self._in_summary:
+                self._closed_summaries.extend(self._summary_parts)
+                self._summary_parts = []
+            self._in_summary = not self._in_summary
+
+        # Longitud del sufijo del buffer que podría ser el inicio de la etiqueta
+        keep = next((k for k in range(min(len(tag) - 1, len(self._buffer)), 0, -1) if self._buffer.endswith(tag[:k])), 0)
+        self._emit(self._buffer[:len(self._buffer) - keep], visible)
+        self._buffer = self._buffer[len(self._buffer) - keep:]
+
+        return "".join(visible)
+
+    def finish(self):
+        """Vacía el buffer al terminar el stream. Un resumen sin cierre se muestra como texto crudo."""
+        if self._in_summary:
+            print("ADVERTENCIA: Resumen interno sin etiqueta de cierre. Se envía como texto crudo.")
+            remaining = "".join(self._summary_parts) + self._buffer
+            self._summary_parts = []
+            self._in_summary = False
+        else:
+            remaining = self._buffer
+        self._buffer = ""
+        return remaining
+
 # --- ENDPOINT PRINCIPAL (SIN CAMBIOS) ---
 
 @app.post("/query")
-async def process_query(data: QueryModel):
+async def process_query(data: QueryModel) -> AnswerModel:
     """Endpoint principal para recibir la pregunta y devolver la respuesta."""
     try:
         # 1. Validación de Seguridad
         if not await validate_recaptcha(data.recaptcha_token):
               raise HTTPException(status_code=403, detail="Validación reCAPTCHA fallida. Acceso denegado.")
 
-        # 2. Generación de Respuesta (RAG y LLM)
-        query_embedding = generate_embedding(data.question)
-        query_results = retrieve_context(query_embedding)
-        raw_llm_response = generate_final_response(data.question, query_results, data.history)
+        # 2. Consultas fuera de especialidad: respuesta fija sin costo de OpenAI/Pinecone
+        direct_response = dispatch_out_of_scope(data.question, data.history)
+        if direct_response:
+            return AnswerModel(answer=direct_response)
 
-        # 3. Lógica para DETECTAR y ENVIAR el resumen interno
-        summary_start_tag = "[INTERNAL_SUMMARY_START]"
-        summary_end_tag = "[INTERNAL_SUMMARY_END]"
+        # 3. Generación de Respuesta (RAG y LLM)
+        query_results = await get_query_context(data.question)
+        # Llamadas bloqueantes (OpenAI síncrono, SendGrid) en un hilo: el event loop sigue atendiendo otras consultas
+        raw_llm_response = await asyncio.to_thread(generate_final_response, data.question, query_results, data.history)
+
+        # 4. Lógica para DETECTAR y ENVIAR el resumen interno
+        summary_start_tag = SUMMARY_START_TAG
+        summary_end_tag = SUMMARY_END_TAG
         
         if summary_start_tag in raw_llm_response and summary_end_tag in raw_llm_response:
             try:
                 # Extraer y enviar el contenido del resumen
                 summary_content = raw_llm_response.split(summary_start_tag)[1].split(summary_end_tag)[0].strip()
-                send_summary_email(summary_content, summary_content)
+                await asyncio.to_thread(send_summary_email, summary_content, summary_content)
                 
                 # Limpiar la respuesta para el usuario
                 user_response = raw_llm_response.replace(summary_start_tag + summary_content + summary_end_tag, "").strip()
@@ -264,8 +612,57 @@ async def process_query(data: QueryModel):
             # Si no hay etiquetas, la respuesta va directamente al usuario
             user_response = raw_llm_response
 
-        return {"answer": user_response}
+        return AnswerModel(answer=user_response)
+
+    except Exception as e:
+        print(f"Error procesando la consulta: {e}")
+        raise HTTPException(status_code=500, detail="Error interno del servidor al procesar la solicitud.")
+
+def sse_token_generator(question, context, history):
+    """
+    Emite la respuesta como eventos SSE y envía el resumen interno cuando el stream termina bien.
+    Si OpenAI falla o el cliente se desconecta a mitad de camino, no se envía ningún resumen.
+    """
+    summary_filter = SummaryStreamFilter()
+    try:
+        for token in stream_final_response(question, context, history):
+            visible = summary_filter.feed(token)
+            if visible:
+                yield f"data: {orjson.dumps({'delta': visible}).decode()}\n\n"
+
+        visible = summary_filter.finish()
+        if visible:
+            yield f"data: {orjson.dumps({'delta': visible}).decode()}\n\n"
+        if summary_filter.summary:
+            send_summary_email(summary_filter.summary, summary_filter.summary)
+        yield f"data: {orjson.dumps({'done': True}).decode()}\n\n"
+
+    except Exception as e:
+        print(f"Error durante el streaming de la respuesta: {e}")
+        yield f"data: {orjson.dumps({'error': 'Error interno del servidor al procesar la solicitud.'}).decode()}\n\n"
+
+@app.post("/query/stream")
+async def process_query_stream(data: QueryModel):
+    """Variante en streaming (SSE) del endpoint principal: el cliente recibe los tokens a medida que se generan."""
+    try:
+        if not await validate_recaptcha(data.recaptcha_token):
+            raise HTTPException(status_code=403, detail="Validación reCAPTCHA fallida. Acceso denegado.")
+
+        direct_response = dispatch_out_of_scope(data.question, data.history)
+        if direct_response:
+            return StreamingResponse(
+                iter([f"data: {orjson.dumps({'delta': direct_response}).decode()}\n\n", f"data: {orjson.dumps({'done': True}).decode()}\n\n"]),
+                media_type="text/event-stream"
+            )
+
+        query_results = await get_query_context(data.question)
+        return StreamingResponse(
+            sse_token_generator(data.question, query_results, data.history),
+            media_type="text/event-stream"
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error procesando la consulta: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor al procesar la solicitud.")
@@ -1,9 +1,11 @@
 import os
-import json
 import logging
 import asyncio
+import operator
 from typing import Dict, Any
 
+import orjson
+
 # Dependencias de Llama Index
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.core.settings import Settings
@@ -19,6 +21,7 @@ logger = logging.getLogger(__name__)
 
 # Define la ruta donde GitHub Actions dejó los archivos del índice
 STORAGE_DIR = "./storage"
+_NODE_FIELDS = operator.attrgetter("text", "score")
 INDEX: Any = None
 QUERY_ENGINE: BaseQueryEngine = None
 
@@ -83,14 +86,14 @@ async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if QUERY_ENGINE is None:
         return {
             "statusCode": 503,
-            "body": json.dumps({"error": "Servicio no disponible. El índice falló al cargar."}),
+            "body": orjson.dumps({"error": "Servicio no disponible. El índice falló al cargar."}).decode(),
             "headers": {"Content-Type": "application/json"},
         }
 
     try:
         # 2. Parsear el cuerpo de la solicitud
         if event.get('body'):
-            body_data = json.loads(event['body'])
+            body_data = orjson.loads(event['body'])
             query = body_data.get('query', '')
         else:
             query = event.get('query', '') # Soporte básico para query params si es necesario
@@ -98,7 +101,7 @@ async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if not query:
             return {
                 "statusCode": 400,
-                "body": json.dumps({"error": "Falta el parámetro 'query'."}),
+                "body": orjson.dumps({"error": "Falta el parámetro 'query'."}).decode(),
                 "headers": {"Content-Type": "application/json"},
             }
         
@@ -113,16 +116,16 @@ async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             "response": str(response),
             "source_nodes": [
                 {
-                    "text": node.text.split("...")[0] + "...", # Mostrar solo el inicio
-                    "score": float(node.score),
+                    "text": text.split("...")[0] + "...", # Mostrar solo el inicio
+                    "score": float(score),
                 } 
-                for node in response.source_nodes
+                for text, score in map(_NODE_FIELDS, response.source_nodes)
             ]
         }
 
         return {
             "statusCode": 200,
-            "body": json.dumps(result),
+            "body": orjson.dumps(result).decode(),
             "headers": {"Content-Type": "application/json"},
         }
 
@@ -130,7 +133,7 @@ async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         logger.exception("Error durante la ejecución de la consulta.")
         return {
             "statusCode": 500,
-            "body": json.dumps({"error": f"Error interno del servidor: {str(e)}"}),
+            "body": orjson.dumps({"error": f"Error interno del servidor: {str(e)}"}).decode(),
             "headers": {"Content-Type": "application/json"},
         }
 
@@ -140,7 +143,7 @@ if __name__ == '__main__':
     
     # Simulación de una consulta (debes manejar la clave de entorno localmente)
     test_event = {
-        'body': json.dumps({"query": "¿Cuáles son los requisitos para la solicitud de asilo?"}),
+        'body': orjson.dumps({"query": "¿Cuáles son los requisitos para la solicitud de asilo?"}).decode(),
         'context': {}
     }
     
@@ -20,14 +20,14 @@ def check_count():
         pc = Pinecone(api_key=pinecone_api_key) 
         
         # 3. Conectar al índice
-        # CORRECCIÓN: Se añaden los PARÉNTESIS a list_indexes() para corregir el error
-        if INDEX_NAME not in pc.list_indexes().names:
+        # has_index consulta solo este índice, sin listar todos los del proyecto
+        if not pc.has_index(INDEX_NAME):
              print(f"Error: El índice '{INDEX_NAME}' no existe.")
              return
              
         pinecone_index = pc.Index(INDEX_NAME)
 
-        # 4. Obtener el estado del índice (incluye conteo por namespace)
+        # 4. Obtener el estado del índice en una sola llamada (total y conteo por namespace)
         index_stats = pinecone_index.describe_index_stats()
         
         # 5. Mostrar los resultados
@@ -1,189 +1,1263 @@
 import os
-import requests
+import importlib
+import re
+import sys
+import json
+import logging
+import argparse
+import random
+import asyncio
+import httpx
 import zipfile
-import io
 import shutil
-from tqdm import tqdm
-from openai import OpenAI
-from pinecone import Pinecone
-from unstructured.partition.auto import partition
-from unstructured.chunking.title import chunk_by_title
-import uuid
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tqdm.asyncio import tqdm_asyncio
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+import grpc
+from pinecone.grpc import PineconeGRPC as Pinecone
+from pinecone.exceptions import PineconeException, ServiceException
 import unicodedata 
+import string
+import hashlib
+import sqlite3
+import numpy as np
+import tiktoken
+import pypdfium2 as pdfium
+
+# Configuración de logging (LOG_LEVEL=DEBUG para ver el detalle por lote).
+# El nivel se aplica solo a este script: las librerías (httpx, openai) siguen en WARNING.
+logging.basicConfig(format="%(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
 # --- CONFIGURACIÓN ---
 INDEX_NAME = "sf-abogados-01"
 EMBEDDING_MODEL = "text-embedding-ada-002"
-BATCH_SIZE = 50
+BATCH_SIZE = 100 # Vectores por upsert (máximo recomendado por Pinecone)
+MAX_CONCURRENT_UPSERTS = 8 # Upserts gRPC en vuelo antes de esperar al más antiguo
+EMBED_BATCH_SIZE = 2048 # Máximo de textos por llamada a la API de embeddings
+MAX_EMBED_TOKENS_PER_REQUEST = 300_000 # Límite de tokens por solicitud de embeddings
+MAX_CONCURRENT_EMBEDDINGS = 5 # Llamadas de embeddings en vuelo (respeta el límite de RPM)
+USE_BATCH_API = os.environ.get("USE_BATCH_API") == "1" # Batch API de OpenAI: mitad de costo, hasta 24 h de espera
+BATCH_API_MAX_REQUESTS = 50_000 # Máximo de solicitudes por trabajo de la Batch API
+BATCH_API_POLL_SECONDS = 60
+BATCH_API_RESUME_TIMEOUT = 30 * 60 # Espera máxima al arrancar por trabajos de una ejecución anterior; los que sigan en curso quedan para la siguiente
+EMBED_MAX_ATTEMPTS = 8 # Intentos por lote ante errores transitorios de OpenAI (429, conexión, 5xx)
+RETRY_AFTER_MAX_SECONDS = 60 # Tope de espera aunque Retry-After pida más (evita bloquear el pipeline)
+UPSERT_MAX_ATTEMPTS = 6 # Intentos por lote ante errores transitorios de Pinecone (no disponible, timeout, cuota)
+TRANSIENT_GRPC_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.RESOURCE_EXHAUSTED}
+EMBED_START_JITTER = (0.05, 0.25) # Segundos de espera aleatoria antes de lanzar cada lote
+PIPELINE_QUEUE_SIZE = 64 # Capacidad de las colas entre etapas (contrapresión)
 DATA_URL = os.environ.get("DATA_URL")
 TEMP_DATA_DIR = "temp_data"
+DOWNLOAD_CHUNK_SIZE = 1 << 20 # 1 MB por bloque al escribir el ZIP en disco
+DOWNLOAD_CONNECTIONS = 8 # Rangos descargados en paralelo cuando el servidor acepta Range
+DOWNLOAD_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+DOWNLOAD_MAX_ATTEMPTS = 5 # Intentos por rango/flujo ante errores de red o HTTP 429/5xx
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".doc", ".txt", ".md", ".html", ".htm"} # Solo se extraen estos tipos del ZIP
+PDF_STRATEGY = os.environ.get("PDF_STRATEGY", "fast") # "hi_res": análisis de layout de unstructured (mucho más lento)
+MIN_PDF_CHARS_PER_PAGE = 10 # Una página con menos caracteres se trata como escaneada (OCR con unstructured)
+CHUNK_MAX_TOKENS = 200 # Tamaño máximo de chunk en tokens del modelo de embeddings
+CHUNK_OVERLAP_TOKENS = 20 # Tokens del trozo anterior que se repiten al partir un texto largo
+CHUNK_MIN_TOKENS = 100 # Los chunks más pequeños se fusionan con su vecino si caben
+SPLIT_SEPARATORS = ("\n\n", "\n", ". ", " ") # Párrafo → línea → frase → palabra
+CHUNKER_VERSION = "tokens-200-20-100-v4" # Cambiarlo al modificar el troceado fuerza a re-trocear todos los archivos
+MAX_EXTRACT_FILE_SIZE = 50_000_000 # Bytes; archivos más grandes se omiten (logs, volcados, zip-bombs)
+CACHE_DIR = os.environ.get("INDEX_CACHE_DIR", ".index_cache") # Persistente entre ejecuciones (fuera de TEMP_DATA_DIR)
+EMBEDDING_CACHE_PATH = os.path.join(CACHE_DIR, "embeddings.sqlite")
+PROCESSED_IDS_PATH = os.path.join(CACHE_DIR, "processed_ids.txt") # IDs ya subidos a Pinecone (checkpoint)
+MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.jsonl") # Una línea por archivo procesado: SHA-256 del contenido e IDs de sus chunks
+PARSED_CHUNKS_DIR = os.path.join(CACHE_DIR, "chunks") # Chunks ya particionados, un NDJSON por SHA-256 de archivo
+BATCH_JOBS_PATH = os.path.join(CACHE_DIR, "batch_jobs.txt") # Trabajos de Batch API en curso, para retomarlos si se corta la ejecución
+DELETE_BATCH_SIZE = 1000 # Máximo de IDs por llamada a delete en Pinecone
+FETCH_BATCH_SIZE = 200 # IDs por fetch al comprobar qué chunks ya existen (la respuesta incluye los vectores)
+ZIP_VERSION_PATH = os.path.join(CACHE_DIR, "zip_version.txt") # ETag/Last-Modified del último ZIP indexado por completo
+LEGACY_CLEANUP_PATH = os.path.join(CACHE_DIR, "legacy_ids_deleted") # Marca: ya se borraron los vectores con IDs uuid4
+# IDs del esquema anterior ("{archivo}_{i}_{uuid4}"): no están en el manifiesto, así que el borrado de obsoletos no los ve
+LEGACY_CHUNK_ID = re.compile(r'_\d+_[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$')
+
+def remote_zip_version(url: str):
+    """
+    Consulta con HEAD la versión del ZIP remoto (ETag o, si no hay, Last-Modified).
+    Devuelve None si el servidor no la informa o no acepta HEAD; en ese caso siempre se descarga.
+    """
+    if not url:
+        return None
+    try:
+        response = httpx.head(url, timeout=30, follow_redirects=True)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning("Advertencia: No se pudo consultar la versión del ZIP (%s). Se descargará igualmente.", e)
+        return None
+    return response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+
+def read_indexed_zip_version():
+    if not os.path.exists(ZIP_VERSION_PATH):
+        return None
+    with open(ZIP_VERSION_PATH, encoding="utf-8") as f:
+        return f.read().strip() or None
+
+
+def write_indexed_zip_version(version: str):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(ZIP_VERSION_PATH, "w", encoding="utf-8") as f:
+        f.write(version)
+
+
+def is_retryable_download_error(exception: BaseException) -> bool:
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code in RETRYABLE_STATUS
+    return isinstance(exception, httpx.TransportError)
+
+
+def log_download_retry(retry_state):
+    logger.warning(
+        "Advertencia: Error al descargar (%s, intento %d). Reintentando en %.1fs...",
+        retry_state.outcome.exception(), retry_state.attempt_number, retry_state.next_action.sleep
+    )
+
+
+# Cada rango (o el flujo completo) se reintenta por separado: reescribe desde su propio inicio
+download_retry = retry(
+    retry=retry_if_exception(is_retryable_download_error),
+    wait=wait_exponential_jitter(initial=0.3, max=30),
+    stop=stop_after_attempt(DOWNLOAD_MAX_ATTEMPTS),
+    before_sleep=log_download_retry,
+    reraise=True
+)
+
+
+@download_retry
+async def download_range(client: httpx.AsyncClient, url: str, path: str, start: int, end: int) -> bool:
+    """Descarga los bytes [start, end] y los escribe en su posición del archivo. False si el servidor ignora Range."""
+    async with client.stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            return False
+        with open(path, "r+b") as f:
+            f.seek(start)
+            async for block in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                f.write(block)
+    return True
+
+
+@download_retry
+async def download_stream(client: httpx.AsyncClient, url: str, path: str):
+    """Descarga url completa en un solo flujo."""
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(path, "wb") as f:
+            async for block in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                f.write(block)
+
+
+async def download_file(url: str, path: str):
+    """
+    Descarga url en path. Si el servidor informa el tamaño y acepta Range, se descargan
+    DOWNLOAD_CONNECTIONS rangos en paralelo; si no (o si responde 200 en lugar de 206), un solo flujo.
+    """
+    # Un único cliente (pool de conexiones) para el HEAD y todos los rangos; reintenta también las conexiones fallidas.
+    # HTTP/1.1 a propósito: con HTTP/2 httpcore multiplexa todos los rangos en una sola conexión TCP
+    # (una sola ventana de congestión) y el paralelismo no aporta ancho de banda
+    transport = httpx.AsyncHTTPTransport(http2=False, retries=DOWNLOAD_MAX_ATTEMPTS)
+    async with httpx.AsyncClient(transport=transport, follow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as client:
+        head = await client.head(url)
+        size = int(head.headers.get("Content-Length", 0)) if head.is_success else 0
+
+        if head.headers.get("Accept-Ranges") == "bytes" and size >= DOWNLOAD_CONNECTIONS * DOWNLOAD_CHUNK_SIZE:
+            with open(path, "wb") as f:
+                f.truncate(size)
+            part = -(-size // DOWNLOAD_CONNECTIONS)
+            ranges = [(start, min(start + part, size) - 1) for start in range(0, size, part)]
+            logger.info("Descargando %.1f MB en %d rangos paralelos...", size / 1e6, len(ranges))
+            if all(await asyncio.gather(*(download_range(client, url, path, start, end) for start, end in ranges))):
+                return
+
+        await download_stream(client, url, path)
+
 
 def download_and_extract_data(url: str, output_dir: str):
-    """Descarga un archivo ZIP desde la URL externa y extrae su contenido."""
+    """
+    Descarga un archivo ZIP desde la URL externa y extrae su contenido.
+    La descarga se escribe por bloques a un archivo temporal (memoria O(1 MB), no O(tamaño del ZIP)),
+    en rangos paralelos cuando el servidor lo permite, y los miembros se extraen en paralelo con hilos (zlib libera el GIL al descomprimir).
+    """
     if not url:
         raise ValueError("La variable de entorno DATA_URL no está configurada. El script no puede descargar los datos.")
     
-    print(f"Descargando datos desde: {url}")
+    logger.info("Descargando datos desde: %s", url)
     
     os.makedirs(output_dir, exist_ok=True)
+    zip_path = None
     
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status() 
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as tmp:
+            zip_path = tmp.name
+        asyncio.run(download_file(url, zip_path))
+
+        with zipfile.ZipFile(zip_path) as z:
+            def extract_member(member):
+                try:
+                    z.extract(member, output_dir)
+                except FileExistsError:
+                    # Otro hilo creó el mismo directorio padre en paralelo; reintentar
+                    z.extract(member, output_dir)
+
+            members = [member for member in z.infolist() if is_indexable_member(member)]
+            logger.info("Extrayendo %d de %d entradas del ZIP (se omiten tipos no soportados y archivos del sistema).", len(members), len(z.infolist()))
 
-        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            z.extractall(output_dir)
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(extract_member, members))
         
-        print(f"Descarga y extracción completadas en: {output_dir}")
+        logger.info("Descarga y extracción completadas en: %s", output_dir)
         return True
     
-    except requests.exceptions.RequestException as e:
-        print(f"Error al descargar o conectar: {e}")
+    except httpx.HTTPError as e:
+        logger.error("Error al descargar o conectar: %s", e)
         return False
     except zipfile.BadZipFile:
-        print("Error: El archivo descargado no es un archivo ZIP válido.")
+        logger.error("Error: El archivo descargado no es un archivo ZIP válido.")
         return False
     except Exception as e:
-        print(f"Ocurrió un error inesperado durante la descarga: {e}")
+        logger.error("Ocurrió un error inesperado durante la descarga: %s", e)
         return False
+    finally:
+        if zip_path and os.path.exists(zip_path):
+            os.remove(zip_path)
+
+
+def is_indexable_member(member: zipfile.ZipInfo) -> bool:
+    """Indica si un miembro del ZIP es un documento a indexar (descarta carpetas, basura del SO y tipos no soportados)."""
+    if member.is_dir() or member.file_size > MAX_EXTRACT_FILE_SIZE:
+        return False
+    parts = member.filename.split("/")
+    # __MACOSX/, .DS_Store, ._archivo, carpetas ocultas...
+    if any(part.startswith(".") or part == "__MACOSX" for part in parts):
+        return False
+    return os.path.splitext(parts[-1])[1].lower() in SUPPORTED_EXTENSIONS
+
+
+# Tabla de traducción ASCII: todo lo que no sea letra, dígito, '.' o '-' pasa a '_'
+_SAFE_FILENAME_CHARS = set(string.ascii_letters + string.digits + '.-')
+_FILENAME_TRANSLATION = str.maketrans({chr(cp): '_' for cp in range(128) if chr(cp) not in _SAFE_FILENAME_CHARS})
+_UNDERSCORE_RUNS = re.compile(r'_+')
 
 
 def sanitize_filename(filename):
     """Convierte el nombre de archivo a ASCII puro, elimina acentos y reemplaza caracteres no seguros."""
     # 1. Normalizar a NFD (Canonical Decomposition) y codificar a ASCII, ignorando lo que no se puede mapear.
-    normalized = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('utf-8')
-    # 2. Reemplazar caracteres especiales y espacios por guiones bajos.
-    safe_chars = ''.join(c if c.isalnum() or c in ('.', '-') else '_' for c in normalized).replace('__', '_')
+    normalized = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    # 2. Reemplazar caracteres especiales y espacios por guiones bajos (en C, con la tabla precalculada)
+    #    y colapsar las secuencias de guiones bajos en uno solo.
+    safe_chars = _UNDERSCORE_RUNS.sub('_', normalized.translate(_FILENAME_TRANSLATION))
     # 3. Eliminar guiones bajos al inicio/final que puedan ser creados por la limpieza.
     return safe_chars.strip('_')
 
 
-def index_data_optimized(directory: str):
-    """Procesa documentos de forma optimizada, generando embeddings y subiendo a Pinecone."""
-    print("Comenzando la indexación optimizada y subida a Pinecone...")
+def init_parse_worker():
+    """Limita los hilos de OCR por proceso para no saturar los núcleos con varios workers."""
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+# Encabezados de sección en textos legales: cada uno abre un chunk nuevo
+# (solo la palabra clave ignora mayúsculas: el numeral romano en minúscula sería texto corrido, p. ej. "título civil")
+LEGAL_HEADING = re.compile(
+    r'\n(?=(?i:ART[IÍ]CULO|ART\.|CAP[IÍ]TULO|T[IÍ]TULO|SECCI[OÓ]N|P[AÁ]RRAFO)\s+[IVXLC0-9])'
+)
+
 
+def extract_pdf_pages(file_path: str):
+    """
+    Extrae la capa de texto de cada página de un PDF con pdfium, sin análisis de layout.
+    Las páginas con menos de MIN_PDF_CHARS_PER_PAGE caracteres (escaneadas) quedan como None: necesitan OCR.
+    """
+    pdf = pdfium.PdfDocument(file_path)
     try:
-        # Inicialización de clientes
-        pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY")) 
-        openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        
-        print("[DEBUG] Clientes de Pinecone y OpenAI inicializados.")
+        pages = [page.get_textpage().get_text_range() for page in pdf]
+    finally:
+        pdf.close()
+    return [
+        text.replace("\r\n", "\n").replace("\r", "\n") if len(text.strip()) >= MIN_PDF_CHARS_PER_PAGE else None
+        for text in pages
+    ]
 
-        # Inicializar el índice (asumiendo que existe)
-        pinecone_index = pc.Index(INDEX_NAME)
 
+def ocr_pdf_pages(file_path: str, page_indices: list):
+    """
+    Pasa por OCR (unstructured, ocr_only) solo las páginas indicadas, copiándolas a un PDF temporal.
+    Devuelve el texto de cada página en el mismo orden que page_indices.
+    """
+    source = pdfium.PdfDocument(file_path)
+    subset = pdfium.PdfDocument.new()
+    try:
+        subset.import_pages(source, page_indices)
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+            subset_path = tmp.name
+        subset.save(subset_path)
+    finally:
+        subset.close()
+        source.close()
+
+    try:
+        elements = load_partitioner(".pdf")(
+            filename=subset_path, languages=['spa', 'eng'], strategy="ocr_only", infer_table_structure=False
+        )
+    finally:
+        os.remove(subset_path)
+
+    page_texts = [[] for _ in page_indices]
+    for element in elements:
+        page_number = getattr(element.metadata, "page_number", None) or 1
+        if element.text:
+            page_texts[min(page_number, len(page_indices)) - 1].append(element.text)
+    return ["\n".join(texts) for texts in page_texts]
+
+
+def split_legal_text(text: str):
+    """Corta el texto en cada encabezado legal; el tamaño de cada sección lo ajusta después resize_chunks."""
+    sections = []
+    for section in LEGAL_HEADING.split(text):
+        lines = [line for line in map(str.strip, section.split("\n")) if line]
+        if lines:
+            sections.append("\n".join(lines))
+    return sections
+
+
+def split_on_titles(elements):
+    """Agrupa los elementos de unstructured en secciones que empiezan en cada Title, como hacía chunk_by_title."""
+    sections = [[]]
+    for element in elements:
+        if not element.text:
+            continue
+        if element.category == "Title" and sections[-1]:
+            sections.append([])
+        sections[-1].append(element.text)
+    return ["\n\n".join(texts) for texts in sections if texts]
+
+
+_chunk_encoding = None
+
+
+def chunk_encoding():
+    """Tokenizador del modelo de embeddings, creado una sola vez por proceso worker."""
+    global _chunk_encoding
+    if _chunk_encoding is None:
+        _chunk_encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    return _chunk_encoding
+
+
+def split_by_tokens(text: str, encoding, max_tokens: int, separators=SPLIT_SEPARATORS):
+    """
+    Divide el texto recursivamente (párrafo → línea → frase → palabra) en trozos de hasta max_tokens.
+    Si ningún separador basta, corta la secuencia de tokens en ventanas fijas.
+    """
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return [text]
+    if not separators:
+        return split_token_windows(tokens, encoding, max_tokens)
+
+    separator, finer = separators[0], separators[1:]
+    separator_size = len(encoding.encode_ordinary(separator))
+    pieces = []
+    current, size = [], 0
+    for part in text.split(separator):
+        part_size = len(encoding.encode_ordinary(part))
+        if current and size + separator_size + part_size > max_tokens:
+            pieces.append(separator.join(current))
+            current, size = [], 0
+        if part_size > max_tokens:
+            pieces.extend(split_by_tokens(part, encoding, max_tokens, finer))
+            continue
+        size += part_size + (separator_size if current else 0)
+        current.append(part)
+    if current:
+        pieces.append(separator.join(current))
+
+    # La suma por partes es una estimación (el BPE puede unir tokens en las juntas): se comprueba el total
+    checked = []
+    for piece in filter(str.strip, pieces):
+        if len(encoding.encode_ordinary(piece)) > max_tokens:
+            checked.extend(split_by_tokens(piece, encoding, max_tokens, finer))
+        else:
+            checked.append(piece)
+    return checked
+
+
+def split_token_windows(tokens: list, encoding, max_tokens: int):
+    """Corta en ventanas de tokens; acorta una ventana si al decodificarla y recodificarla supera max_tokens."""
+    pieces = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        while end > start + 1 and len(encoding.encode_ordinary(encoding.decode(tokens[start:end]))) > max_tokens:
+            end -= 1
+        pieces.append(encoding.decode(tokens[start:end]))
+        start = end
+    return pieces
+
+
+def resize_chunks(texts):
+    """
+    Ajusta los textos a CHUNK_MAX_TOKENS: parte los largos, fusiona los trozos menores de
+    CHUNK_MIN_TOKENS con su vecino si caben y, al final, antepone CHUNK_OVERLAP_TOKENS del trozo
+    anterior a cada chunk que continúa un texto partido. El solapamiento se añade después de
+    fusionar para que nunca quede duplicado dentro de un mismo chunk. Todos los tamaños se miden
+    sobre el texto final (separadores incluidos), así que ningún chunk supera CHUNK_MAX_TOKENS.
+    """
+    encoding = chunk_encoding()
+
+    def count(text):
+        return len(encoding.encode_ordinary(text))
+
+    # Espacio reservado para el solapamiento y el espacio que lo separa del chunk
+    overlap_reserve = CHUNK_OVERLAP_TOKENS + count(" ")
+    pieces = [
+        (source, piece)
+        for source, text in enumerate(texts)
+        for piece in split_by_tokens(text, encoding, CHUNK_MAX_TOKENS - overlap_reserve)
+    ]
+
+    # Grupos de trozos fusionados; "overlap" indica si el grupo continúa el texto del grupo anterior
+    groups = []
+    for source, piece in pieces:
+        size = count(piece)
+        if groups:
+            last = groups[-1]
+            limit = CHUNK_MAX_TOKENS - (overlap_reserve if last["overlap"] else 0)
+            if min(size, last["size"]) < CHUNK_MIN_TOKENS:
+                merged = f"{last['text']}\n\n{piece}"
+                merged_size = count(merged)
+                if merged_size <= limit:
+                    last.update(text=merged, size=merged_size, source=source, piece=piece)
+                    continue
+        overlap = bool(groups) and groups[-1]["source"] == source
+        groups.append({"text": piece, "size": size, "source": source, "piece": piece, "overlap": overlap})
+
+    chunks = []
+    for previous, group in zip([None] + groups, groups):
+        chunk = group["text"]
+        if group["overlap"]:
+            previous_tokens = encoding.encode_ordinary(previous["piece"])
+            # Se acorta el solapamiento si, al unirlo, el BPE produce algún token de más
+            for size in range(CHUNK_OVERLAP_TOKENS, 0, -1):
+                candidate = f"{encoding.decode(previous_tokens[-size:]).strip()} {group['text']}"
+                if count(candidate) <= CHUNK_MAX_TOKENS:
+                    chunk = candidate
+                    break
+        chunks.append(chunk)
+    return chunks
+
+
+# Particionador específico por extensión: evita la detección de tipo y los backends pesados de partition().
+# Se importan al usarse: cada uno depende de un extra distinto de unstructured (pdf, docx, md...)
+PARTITIONERS = {
+    ".pdf": ("unstructured.partition.pdf", "partition_pdf"),
+    ".txt": ("unstructured.partition.text", "partition_text"),
+    ".md": ("unstructured.partition.md", "partition_md"),
+    ".html": ("unstructured.partition.html", "partition_html"),
+    ".htm": ("unstructured.partition.html", "partition_html"),
+    ".docx": ("unstructured.partition.docx", "partition_docx"),
+    ".doc": ("unstructured.partition.doc", "partition_doc"),
+}
+
+
+def load_partitioner(extension: str):
+    module, name = PARTITIONERS.get(extension, ("unstructured.partition.auto", "partition"))
+    return getattr(importlib.import_module(module), name)
+
+
+def parse_file(file_path: str):
+    """
+    Particiona y trocea un archivo (se ejecuta en un proceso worker).
+    Los PDF usan la ruta rápida de pdfium (salvo PDF_STRATEGY=hi_res) y solo sus páginas escaneadas pasan por OCR.
+    El resto de formatos usa el particionador de unstructured correspondiente a su extensión.
+    Devuelve (textos de los chunks, None) o ([], mensaje de error) si el archivo falla.
+    """
+    try:
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == ".pdf":
+            strategy = PDF_STRATEGY
+            if strategy != "hi_res":
+                pages = extract_pdf_pages(file_path)
+                # Páginas escaneadas (todas o solo algunas): únicamente esas pasan por OCR
+                scanned = [i for i, page in enumerate(pages) if page is None]
+                if scanned:
+                    for i, text in zip(scanned, ocr_pdf_pages(file_path, scanned)):
+                        pages[i] = text
+                return resize_chunks(split_legal_text("\n".join(pages))), None
+            elements = load_partitioner(".pdf")(filename=file_path, languages=['spa', 'eng'], strategy=strategy, infer_table_structure=False)
+        else:
+            # Particionamiento: dividir el documento y especificar idiomas (Español/Inglés)
+            elements = load_partitioner(extension)(filename=file_path, languages=['spa', 'eng'])
+
+        # Chunking: una sección por título y después trocear por tokens (párrafo → frase → palabra)
+        return resize_chunks(split_on_titles(elements)), None
     except Exception as e:
-        print(f"Error de inicialización de clientes: {e}")
-        return
-
-    vectors_to_upsert = []
-    total_vectors = 0
-    document_count = 0
-
-    # Iterar sobre los archivos en el directorio
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            print(f"  -> Procesando archivo: {file_path}")
-            
+        # Con el tipo: str(e) queda vacío en excepciones sin mensaje (MemoryError(), AssertionError())
+        return [], f"{type(e).__name__}: {e}"
+
+
+_WHITESPACE_RUNS = re.compile(r'\s+')
+
+
+def normalize_whitespace(text: str) -> str:
+    """Colapsa saltos de línea y espacios repetidos: el texto que se envía a embeddings y se usa como clave."""
+    return _WHITESPACE_RUNS.sub(' ', text).strip()
+
+
+def embedding_cache_key(text: str):
+    """Clave de caché de un chunk: SHA-256 del modelo y el texto normalizado (mismo texto con otro espaciado, misma clave)."""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{normalize_whitespace(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Caché persistente de embeddings en SQLite, indexada por embedding_cache_key."""
+
+    LOOKUP_CHUNK = 500 # Parámetros por consulta (por debajo del límite de SQLite)
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, model TEXT, dim INTEGER, vec BLOB)"
+        )
+
+    def get_many(self, keys: list):
+        """Devuelve un dict clave -> embedding para las claves presentes en la caché."""
+        found = {}
+        for start in range(0, len(keys), self.LOOKUP_CHUNK):
+            chunk = keys[start:start + self.LOOKUP_CHUNK]
+            rows = self.connection.execute(
+                f"SELECT hash, vec FROM embeddings WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for key, vec in rows:
+                found[key] = np.frombuffer(vec, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: list):
+        """Guarda pares (clave, embedding) en una sola transacción."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, model, dim, vec) VALUES (?, ?, ?, ?)",
+                [(key, EMBEDDING_MODEL, len(vec), np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in items]
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+_exponential_backoff = wait_exponential_jitter(initial=1, max=60)
+
+
+def wait_retry_after(retry_state):
+    """
+    Espera lo que indique la cabecera Retry-After del 429 (como máximo RETRY_AFTER_MAX_SECONDS);
+    si no viene, backoff exponencial con jitter.
+    """
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    try:
+        return min(max(float(response.headers["retry-after"]), 0.0), RETRY_AFTER_MAX_SECONDS)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return _exponential_backoff(retry_state)
+
+
+def log_embedding_retry(retry_state):
+    logger.warning(
+        "ADVERTENCIA: Error transitorio de OpenAI (%s, intento %d). Reintentando en %.1fs...",
+        type(retry_state.outcome.exception()).__name__, retry_state.attempt_number, retry_state.next_action.sleep
+    )
+
+
+_GRPC_STATUS = re.compile(r'grpc_status:(\d+)')
+
+
+def is_transient_pinecone_error(exception: BaseException) -> bool:
+    """
+    Solo los errores que pueden resolverse reintentando: UNAVAILABLE, DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED,
+    5xx (ServiceException) y cortes de conexión. Una dimensión errónea o metadatos demasiado grandes fallan al momento.
+    """
+    if isinstance(exception, grpc.RpcError):
+        return exception.code() in TRANSIENT_GRPC_CODES
+    if isinstance(exception, ServiceException):
+        return True
+    if isinstance(exception, PineconeException):
+        # El future gRPC de Pinecone envuelve el RpcError y solo conserva su debug_error_string
+        match = _GRPC_STATUS.search(str(exception))
+        return bool(match) and int(match.group(1)) in {code.value[0] for code in TRANSIENT_GRPC_CODES}
+    return isinstance(exception, (ConnectionError, TimeoutError))
+
+
+def log_upsert_retry(retry_state):
+    logger.warning(
+        "ADVERTENCIA: Falló un upsert a Pinecone (%s, intento %d). Reintentando en %.1fs...",
+        retry_state.outcome.exception(), retry_state.attempt_number, retry_state.next_action.sleep
+    )
+
+
+@retry(
+    # APITimeoutError es subclase de APIConnectionError
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(EMBED_MAX_ATTEMPTS),
+    before_sleep=log_embedding_retry,
+    reraise=True
+)
+async def create_embeddings(client: AsyncOpenAI, texts: list):
+    """Llama al endpoint de embeddings reintentando los 429, cortes de conexión y errores 5xx con backoff."""
+    return await client.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+
+
+class BatchEmbedder:
+    """
+    Genera embeddings con la Batch API de OpenAI: sube un JSONL con una solicitud por texto,
+    crea el trabajo, consulta su estado y reensambla los resultados en orden por `custom_id`.
+    El `custom_id` es la clave de caché del texto y el ID de cada trabajo se anota en BATCH_JOBS_PATH:
+    si la ejecución muere antes de terminar (p. ej. el límite de 6 h de GitHub Actions), la siguiente
+    retoma esos trabajos y guarda sus resultados en la caché en lugar de pagarlos dos veces.
+    """
+
+    TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, client: AsyncOpenAI, cache: EmbeddingCache):
+        self.client = client
+        self.cache = cache
+
+    @staticmethod
+    def _pending_jobs():
+        if not os.path.exists(BATCH_JOBS_PATH):
+            return []
+        with open(BATCH_JOBS_PATH, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    @staticmethod
+    def _record_job(batch_id: str):
+        with open(BATCH_JOBS_PATH, "a", encoding="utf-8") as f:
+            f.write(f"{batch_id}\n")
+
+    def _forget_job(self, batch_id: str):
+        remaining = [job for job in self._pending_jobs() if job != batch_id]
+        with open(BATCH_JOBS_PATH, "w", encoding="utf-8") as f:
+            f.write("".join(f"{job}\n" for job in remaining))
+
+    async def _wait(self, batch_id: str):
+        """Consulta el trabajo hasta que llega a un estado terminal y lo devuelve."""
+        batch = await self.client.batches.retrieve(batch_id)
+        while batch.status not in self.TERMINAL_STATUSES:
+            await asyncio.sleep(BATCH_API_POLL_SECONDS)
+            batch = await self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            logger.warning("ADVERTENCIA: El trabajo de Batch API %s terminó con estado '%s'.", batch_id, batch.status)
+        return batch
+
+    async def _read_results(self, batch):
+        """Descarga la salida de un trabajo terminado: dict custom_id -> embedding (sin las solicitudes fallidas)."""
+        if not batch.output_file_id:
+            raise RuntimeError(f"El trabajo de Batch API {batch.id} no produjo resultados.")
+        results = {}
+        output = await self.client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            record = json.loads(line)
+            response = record.get("response")
+            if response and response.get("status_code") == 200:
+                results[record["custom_id"]] = response["body"]["data"][0]["embedding"]
+        return results
+
+    async def resume_pending(self):
+        """
+        Recoge los trabajos que dejó una ejecución anterior y guarda sus embeddings en la caché.
+        Un trabajo solo se olvida cuando sus resultados quedaron en la caché o terminó sin salida;
+        ante un error de red o si sigue en curso tras BATCH_API_RESUME_TIMEOUT, queda para la próxima ejecución.
+        """
+        for batch_id in self._pending_jobs():
+            logger.info("Retomando el trabajo de Batch API %s de una ejecución anterior...", batch_id)
+            try:
+                async with asyncio.timeout(BATCH_API_RESUME_TIMEOUT):
+                    batch = await self._wait(batch_id)
+                if batch.output_file_id:
+                    results = await self._read_results(batch)
+                    self.cache.put_many(list(results.items()))
+                    logger.info("  -> %d embeddings recuperados del trabajo %s.", len(results), batch_id)
+            except TimeoutError:
+                logger.warning("ADVERTENCIA: El trabajo de Batch API %s sigue en curso; se retomará en la próxima ejecución.", batch_id)
+                continue
+            except Exception as e:
+                logger.warning("ADVERTENCIA: No se pudo recuperar el trabajo de Batch API %s: %s", batch_id, e)
+                continue
+            self._forget_job(batch_id)
+
+    async def embed(self, texts: list):
+        """Devuelve una lista alineada con `texts` (None para las solicitudes que fallaron)."""
+        keys = [embedding_cache_key(text) for text in texts]
+        requests_jsonl = "\n".join(
+            json.dumps({
+                "custom_id": key,
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {"model": EMBEDDING_MODEL, "input": text}
+            })
+            for key, text in zip(keys, texts)
+        )
+        input_file = await self.client.files.create(
+            file=("embeddings.jsonl", requests_jsonl.encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h"
+        )
+        self._record_job(batch.id)
+        logger.debug("Trabajo de Batch API %s creado con %d solicitudes.", batch.id, len(texts))
+
+        results = await self._read_results(await self._wait(batch.id))
+        self._forget_job(batch.id) # El llamador guarda los resultados en la caché
+        embeddings = [results.get(key) for key in keys]
+
+        failed = embeddings.count(None)
+        if failed:
+            logger.warning("ADVERTENCIA: %d solicitudes del trabajo %s fallaron y se omitirán.", failed, batch.id)
+        return embeddings
+
+
+def chunk_id(sanitized_file: str, text: str) -> str:
+    """ID direccionado por contenido: el mismo chunk produce el mismo ID en cada ejecución."""
+    return f"{sanitized_file}_{hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}"
+
+
+def load_processed_ids(path: str) -> set:
+    """Lee el checkpoint de IDs ya subidos. Un archivo inexistente equivale a un índice vacío."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def iter_files(root: str):
+    """
+    Recorre root recursivamente con os.scandir y produce las rutas de los documentos a indexar.
+    Omite entradas ocultas y extensiones no soportadas antes de llegar al particionador.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name == "__MACOSX":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXTENSIONS:
+                yield entry.path
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 de la versión del troceado y del contenido del archivo, leído por bloques."""
+    digest = hashlib.sha256(CHUNKER_VERSION.encode())
+    with open(path, "rb") as f:
+        while block := f.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path: str):
+    """
+    Lee el manifiesto (JSONL de solo anexar). Devuelve la última entrada de cada archivo,
+    ruta relativa -> {"sha256", "ids"}, y el conjunto de todos los IDs registrados en alguna línea
+    (incluye los de versiones anteriores de un archivo, para poder borrarlos).
+    """
+    entries, known_ids = {}, set()
+    if not os.path.exists(path):
+        return entries, known_ids
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Última línea truncada por una ejecución interrumpida
+            entries[record["file"]] = {"sha256": record["sha256"], "ids": record["ids"]}
+            known_ids.update(record["ids"])
+    return entries, known_ids
+
+
+def manifest_line(relative_path: str, entry: dict) -> str:
+    return json.dumps({"file": relative_path, "sha256": entry["sha256"], "ids": entry["ids"]}) + "\n"
+
+
+def parsed_chunks_path(digest: str) -> str:
+    return os.path.join(PARSED_CHUNKS_DIR, f"{digest}.ndjson")
+
+
+def load_parsed_chunks(digest: str):
+    """Lee los chunks de un archivo ya particionado (una línea JSON por chunk), o None si no están en caché."""
+    try:
+        with open(parsed_chunks_path(digest), encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_parsed_chunks(digest: str, texts: list):
+    """Guarda los chunks de un archivo recién particionado (reemplazo atómico)."""
+    path = parsed_chunks_path(digest)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(text, ensure_ascii=False) + "\n" for text in texts)
+    os.replace(tmp_path, path)
+
+
+def prune_parsed_chunks(digests: set):
+    """Borra los chunks de versiones de archivos que ya no figuran en el manifiesto."""
+    with os.scandir(PARSED_CHUNKS_DIR) as entries:
+        for entry in entries:
+            if entry.name.removesuffix(".ndjson") not in digests:
+                os.remove(entry.path)
+
+
+def compact_manifest(path: str, manifest: dict):
+    """Reescribe el manifiesto con una línea por archivo actual (reemplazo atómico)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(manifest_line(relative_path, entry) for relative_path, entry in manifest.items())
+    os.replace(tmp_path, path)
+
+
+def delete_vectors(pinecone_index, ids: list):
+    """Elimina de Pinecone los vectores indicados, en lotes de DELETE_BATCH_SIZE."""
+    for start in range(0, len(ids), DELETE_BATCH_SIZE):
+        pinecone_index.delete(ids=ids[start:start + DELETE_BATCH_SIZE], namespace="")
+
+
+def delete_legacy_vectors(pinecone_index):
+    """
+    Limpieza única de los vectores subidos con IDs aleatorios (uuid4) antes de los IDs por contenido.
+    Recorre los IDs del índice con list() (solo índices serverless) y borra los que siguen el esquema anterior.
+    """
+    legacy_ids = [
+        vector_id
+        for page in pinecone_index.list(namespace="")
+        for vector_id in page
+        if LEGACY_CHUNK_ID.search(vector_id)
+    ]
+    if legacy_ids:
+        logger.info("Eliminando %d vectores con IDs del esquema anterior (uuid4)...", len(legacy_ids))
+        delete_vectors(pinecone_index, legacy_ids)
+    with open(LEGACY_CLEANUP_PATH, "w", encoding="utf-8") as f:
+        f.write(f"{len(legacy_ids)}\n")
+
+
+async def fetch_existing_ids(pinecone_index, ids: list) -> set:
+    """Devuelve el subconjunto de ids que ya existen en Pinecone, consultando en lotes de FETCH_BATCH_SIZE."""
+    existing = set()
+    for start in range(0, len(ids), FETCH_BATCH_SIZE):
+        response = await asyncio.wrap_future(
+            pinecone_index.fetch(ids=ids[start:start + FETCH_BATCH_SIZE], namespace="", async_req=True)
+        )
+        existing.update(response.vectors)
+    return existing
+
+
+def submit_upsert(pinecone_index, vectors: list):
+    """Envía un lote a Pinecone por gRPC sin bloquear (async_req=True). Devuelve un future."""
+    return pinecone_index.upsert(
+        vectors=vectors,
+        namespace="",
+        async_req=True
+    )
+
+
+@retry(
+    retry=retry_if_exception(is_transient_pinecone_error),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(UPSERT_MAX_ATTEMPTS),
+    before_sleep=log_upsert_retry,
+    reraise=True
+)
+async def upsert_vectors(pinecone_index, vectors: list):
+    """Sube un lote por gRPC y espera la confirmación sin bloquear el bucle, reintentando con backoff."""
+    return await asyncio.wrap_future(submit_upsert(pinecone_index, vectors))
+
+
+async def run_indexing_pipeline(directory: str, pinecone_index, openai_api_key: str, force_reindex: bool = False):
+    """
+    Pipeline de indexación en 3 etapas concurrentes conectadas por colas acotadas:
+    (1) particionar/trocear archivos en un pool de procesos, (2) generar embeddings por lotes
+    (caché + OpenAI) y (3) subir vectores a Pinecone. Las colas acotadas dan contrapresión,
+    así el tiempo total tiende al de la etapa más lenta y no a la suma de las tres.
+    Los archivos sin cambios desde la última ejecución no se vuelven a particionar, y los vectores
+    de archivos modificados o eliminados se borran del índice al final.
+    Con force_reindex se ignoran el checkpoint y la consulta a Pinecone, y se vuelve a subir todo.
+    """
+    loop = asyncio.get_running_loop()
+    chunk_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE) # Listas de chunks por archivo
+    vector_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE) # Listas de vectores listos para subir
+    embedding_slots = asyncio.Semaphore(MAX_CONCURRENT_EMBEDDINGS)
+    upsert_slots = asyncio.Semaphore(MAX_CONCURRENT_UPSERTS)
+    # HTTP/2: los lotes concurrentes comparten una conexión en lugar de abrir una por solicitud.
+    # Sin reintentos del SDK: los gestiona tenacity (wait_retry_after), que no multiplica los intentos
+    client = AsyncOpenAI(api_key=openai_api_key, http_client=DefaultAsyncHttpxClient(http2=True), max_retries=0)
+    cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+    encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    batch_embedder = BatchEmbedder(client, cache) if USE_BATCH_API else None
+    stats = {"documents": 0, "unchanged": 0, "chunks": 0, "cache_hits": 0, "duplicates": 0, "skipped": 0, "vectors": 0, "deleted": 0}
+    # Archivos que fallaron o vectores obsoletos sin borrar: la próxima ejecución no debe tomar el atajo del ZIP
+    stats["incomplete"] = False
+    # Embeddings en curso por clave de caché: un texto repetido (encabezados, cláusulas estándar)
+    # se envía a OpenAI una sola vez aunque aparezca varias veces en el mismo lote o en varios lotes en vuelo
+    embeddings_in_flight = {}
+
+    # Checkpoint: los chunks ya subidos en una ejecución anterior (incluso interrumpida) se omiten
+    processed_ids = set() if force_reindex else load_processed_ids(PROCESSED_IDS_PATH)
+    if processed_ids:
+        logger.info("Checkpoint encontrado: %d chunks ya indexados se omitirán.", len(processed_ids))
+    checkpoint = open(PROCESSED_IDS_PATH, "w" if force_reindex else "a", encoding="utf-8")
+
+    # Manifiesto: decide qué archivos no cambiaron. Cada archivo procesado se anexa al momento,
+    # así una ejecución interrumpida no vuelve a particionar lo que ya terminó
+    manifest, known_ids = load_manifest(MANIFEST_PATH)
+    new_manifest = {}
+    manifest_log = open(MANIFEST_PATH, "a", encoding="utf-8")
+    os.makedirs(PARSED_CHUNKS_DIR, exist_ok=True)
+
+    # --- ETAPA 1: particionar y trocear (un proceso por núcleo) ---
+    async def parse_stage(executor):
+        file_paths = list(iter_files(directory))
+
+        async def parse_one(file_path):
+            digest = await loop.run_in_executor(None, file_sha256, file_path)
+            previous = manifest.get(os.path.relpath(file_path, directory))
+            # Mismo contenido y todos sus chunks ya subidos: no hace falta particionarlo de nuevo
+            if previous and previous["sha256"] == digest and processed_ids.issuperset(previous["ids"]):
+                return file_path, digest, None, None
+            # Ya particionado en una ejecución que falló después (embeddings, Pinecone): no repetir partition()
+            if not force_reindex:
+                texts = await loop.run_in_executor(None, load_parsed_chunks, digest)
+                if texts is not None:
+                    return file_path, digest, texts, None
+            texts, error = await loop.run_in_executor(executor, parse_file, file_path)
+            if error is None:
+                await loop.run_in_executor(None, save_parsed_chunks, digest, texts)
+            return file_path, digest, texts, error
+
+        # Progreso por archivo terminado (no por archivo lanzado); sin barra fuera de una terminal (CI)
+        for next_parsed in tqdm_asyncio.as_completed(
+            [parse_one(file_path) for file_path in file_paths],
+            total=len(file_paths), desc="Archivos", unit="archivo", disable=not sys.stderr.isatty()
+        ):
+            file_path, digest, texts, error = await next_parsed
+            file = os.path.basename(file_path)
+            relative_path = os.path.relpath(file_path, directory)
+
+            if texts is None and error is None:
+                new_manifest[relative_path] = manifest[relative_path]
+                stats["unchanged"] += 1
+                continue
+
+            if error is not None:
+                logger.error("ERROR FATAL al procesar el archivo %s: %s", file, error)
+                stats["incomplete"] = True
+                # Conservar los vectores de la versión anterior en lugar de borrarlos
+                if relative_path in manifest:
+                    new_manifest[relative_path] = manifest[relative_path]
+                continue
+
             # --- SANITIZACIÓN DE ID ---
             sanitized_file = sanitize_filename(file)
             # --------------------------------
 
-            try:
-                # 1. Particionamiento: dividir el documento y especificar idiomas (Español/Inglés)
-                elements = partition(filename=file_path, languages=['spa', 'eng'])
-                
-                # 2. Chunking: agrupar en fragmentos lógicos
-                chunks = chunk_by_title(elements)
-                
-                # 3. Procesar los chunks del archivo
-                for i, chunk in enumerate(chunks):
-                    if chunk.text.strip():
-                        text = chunk.text
-                        # Usar el nombre de archivo SANITIZADO para el ID del vector
-                        chunk_id = f"{sanitized_file}_{i}_{uuid.uuid4()}" 
-                        
-                        # Generar embeddings para el chunk
-                        try:
-                            # [DEBUG] Mensaje antes de la llamada a OpenAI
-                            print(f"[DEBUG] Generando embedding para chunk {total_vectors+1}. Total actual de vectores: {total_vectors}. ID: {chunk_id[:50]}...")
-                            
-                            response = openai_client.embeddings.create(
-                                input=[text],
-                                model=EMBEDDING_MODEL
-                            )
-                            embedding = response.data[0].embedding
-                            
-                            # Preparar vector para upsert
-                            vector = {
-                                'id': chunk_id,
-                                'values': embedding,
-                                'metadata': {
-                                    "file_name": file, # Guardamos el nombre original en metadata
-                                    "chunk_id": chunk_id,
-                                    "text": text
-                                }
-                            }
-                            vectors_to_upsert.append(vector)
-                            total_vectors += 1
-
-                        except Exception as e:
-                            print(f"Error al generar embedding para chunk en {file}: {e}. Saltando chunk.")
-                            continue
-
-                        # Subir el lote a Pinecone cuando alcance BATCH_SIZE
-                        if len(vectors_to_upsert) >= BATCH_SIZE:
-                            # [DEBUG] Mensaje antes de la llamada a Pinecone
-                            print(f"[DEBUG] Subiendo lote de {len(vectors_to_upsert)} vectores a Pinecone. Total acumulado: {total_vectors}")
-                            try:
-                                pinecone_index.upsert(
-                                    vectors=vectors_to_upsert,
-                                    namespace=""
-                                )
-                                vectors_to_upsert = [] # Limpiar el lote para el siguiente
-                            except Exception as e:
-                                print(f"Error al subir lote a Pinecone: {e}. Descartando lote fallido.")
-                                vectors_to_upsert = []
+            # Usar el nombre de archivo SANITIZADO + hash del texto para el ID del vector
+            # (un chunk repetido dentro del mismo archivo produce el mismo ID y se sube una sola vez)
+            file_chunks = {}
+            for text in texts:
+                if text.strip():
+                    file_chunks.setdefault(chunk_id(sanitized_file, text), (file, text))
 
-            except Exception as e:
-                print(f"ERROR FATAL al procesar el archivo {file}: {e}")
-                continue
-            
-            document_count += 1
-            print(f"  -> Archivo {document_count} procesado. Total de vectores subidos: {total_vectors}")
+            pending = [(cid, file, text) for cid, (file, text) in file_chunks.items() if cid not in processed_ids]
+            new_manifest[relative_path] = {"sha256": digest, "ids": list(file_chunks)}
+            manifest_log.write(manifest_line(relative_path, new_manifest[relative_path]))
+            manifest_log.flush()
+
+            # Los IDs son hashes del contenido: si Pinecone ya los tiene (p. ej. se perdió la caché local),
+            # no hace falta generar el embedding ni volver a subirlos
+            if pending and not force_reindex:
+                try:
+                    existing = await fetch_existing_ids(pinecone_index, [cid for cid, _, _ in pending])
+                except Exception as e:
+                    logger.warning("Advertencia: No se pudo consultar Pinecone para %s: %s. Se indexarán todos sus chunks.", file, e)
+                    existing = set()
+                if existing:
+                    pending = [chunk for chunk in pending if chunk[0] not in existing]
+                    checkpoint.write("".join(f"{vector_id}\n" for vector_id in existing))
+                    checkpoint.flush()
 
-    # Subir vectores restantes (lote final)
-    if vectors_to_upsert:
-        print(f"[DEBUG] Subiendo lote final de {len(vectors_to_upsert)} vectores restantes.")
+            stats["documents"] += 1
+            stats["chunks"] += len(file_chunks)
+            stats["skipped"] += len(file_chunks) - len(pending)
+            logger.info("  -> Archivo %d procesado (%s). Chunks acumulados: %d", stats['documents'], file_path, stats['chunks'])
+            if pending:
+                await chunk_queue.put(pending)
+
+        await chunk_queue.put(None)
+
+    # --- ETAPA 2: embeddings (caché + OpenAI, varios lotes en vuelo) ---
+    async def embed_texts(texts: list):
+        if batch_embedder:
+            return await batch_embedder.embed(texts)
+
+        # Jitter al inicio para que los lotes concurrentes no golpeen la API al mismo tiempo
+        await asyncio.sleep(random.uniform(*EMBED_START_JITTER))
+        response = await create_embeddings(client, texts)
+        # Cada resultado se escribe en su posición original para preservar el orden
+        embeddings = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = item.embedding
+        return embeddings
+
+    async def embed_chunks(batch_number: int, batch: list):
         try:
-            pinecone_index.upsert(
-                vectors=vectors_to_upsert,
-                namespace=""
+            cache_keys = [embedding_cache_key(text) for _, _, text in batch]
+            cached = cache.get_many(cache_keys)
+            embeddings = [cached.get(key) for key in cache_keys]
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            stats["cache_hits"] += len(batch) - len(missing)
+
+            # Este lote genera solo los textos que nadie está generando; el resto espera el future del dueño
+            owned = {}
+            futures = {}
+            for i in missing:
+                key = cache_keys[i]
+                if key not in embeddings_in_flight:
+                    embeddings_in_flight[key] = loop.create_future()
+                    owned[key] = normalize_whitespace(batch[i][2])
+                futures[i] = embeddings_in_flight[key]
+            stats["duplicates"] += len(missing) - len(owned)
+
+            if owned:
+                logger.debug(
+                    "Lote %d: generando %d embeddings (%d desde caché, %d duplicados).",
+                    batch_number, len(owned), len(batch) - len(missing), len(missing) - len(owned)
+                )
+                new_embeddings = {}
+                try:
+                    new_embeddings = dict(zip(owned, await embed_texts(list(owned.values()))))
+                    cache.put_many([(key, embedding) for key, embedding in new_embeddings.items() if embedding is not None])
+                finally:
+                    # Resolver siempre (None si falló) para no bloquear a quien espera estos textos.
+                    # Ya guardados en la caché, no hace falta retenerlos en memoria.
+                    for key in owned:
+                        embeddings_in_flight.pop(key).set_result(new_embeddings.get(key))
+
+            for i, future in futures.items():
+                embeddings[i] = await future
+
+            await vector_queue.put([
+                {
+                    'id': chunk_id,
+                    'values': embedding,
+                    'metadata': {
+                        "file_name": file, # Guardamos el nombre original en metadata
+                        "chunk_id": chunk_id,
+                        "text": text
+                    }
+                }
+                for (chunk_id, file, text), embedding in zip(batch, embeddings)
+                if embedding is not None
+            ])
+
+        except Exception as e:
+            # Los IDs quedan fuera del checkpoint: la próxima ejecución los vuelve a intentar
+            logger.error(
+                "Error al generar embeddings del lote %d: %s. Saltando lote. IDs omitidos: %s",
+                batch_number, e, ", ".join(chunk_id for chunk_id, _, _ in batch)
             )
-            total_vectors += len(vectors_to_upsert)
+        finally:
+            embedding_slots.release()
+
+    async def embed_stage():
+        tasks = []
+        pending = []
+        pending_tokens = 0
+        # Con la Batch API cada texto es su propia solicitud: el lote es un trabajo completo
+        max_items = BATCH_API_MAX_REQUESTS if batch_embedder else EMBED_BATCH_SIZE
+        max_tokens = float("inf") if batch_embedder else MAX_EMBED_TOKENS_PER_REQUEST
+
+        async def flush():
+            # Esperar un cupo antes de lanzar el lote: si OpenAI va lento, esta etapa deja de consumir la cola
+            await embedding_slots.acquire()
+            tasks.append(asyncio.create_task(embed_chunks(len(tasks), pending)))
+
+        def count_tokens(texts):
+            # encode_ordinary_batch tokeniza en paralelo dentro de tiktoken (fuera del GIL)
+            return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+
+        while (file_chunks := await chunk_queue.get()) is not None:
+            # Una sola tokenización por archivo, en un hilo para no bloquear el bucle de eventos
+            token_counts = await loop.run_in_executor(None, count_tokens, [text for _, _, text in file_chunks])
+            for chunk, tokens in zip(file_chunks, token_counts):
+                # Cerrar el lote al llegar al máximo de textos o al límite de tokens por solicitud
+                if pending and (len(pending) >= max_items or pending_tokens + tokens > max_tokens):
+                    await flush()
+                    pending, pending_tokens = [], 0
+                pending.append(chunk)
+                pending_tokens += tokens
+
+        if pending:
+            await flush()
+        await asyncio.gather(*tasks)
+        await vector_queue.put(None)
+
+    # --- ETAPA 3: subida a Pinecone en lotes de BATCH_SIZE (gRPC, varios lotes en vuelo) ---
+    async def upsert_batch(batch: list):
+        ids = [vector['id'] for vector in batch]
+        try:
+            await upsert_vectors(pinecone_index, batch)
+        except Exception as e:
+            logger.error("Error al subir lote a Pinecone: %s. IDs no subidos: %s", e, ", ".join(ids))
+            return
+        finally:
+            upsert_slots.release()
+        # Solo los lotes confirmados por Pinecone entran al checkpoint
+        stats["vectors"] += len(ids)
+        checkpoint.write("".join(f"{vector_id}\n" for vector_id in ids))
+        checkpoint.flush()
+
+    async def upsert_stage():
+        vectors_to_upsert = []
+        tasks = []
+
+        async def upsert(batch):
+            # Con el cupo lleno, esperar a que termine algún lote: acota la memoria retenida por los lotes en vuelo
+            await upsert_slots.acquire()
+            tasks.append(asyncio.create_task(upsert_batch(batch)))
+
+        while (vectors := await vector_queue.get()) is not None:
+            vectors_to_upsert.extend(vectors)
+            while len(vectors_to_upsert) >= BATCH_SIZE:
+                batch, vectors_to_upsert = vectors_to_upsert[:BATCH_SIZE], vectors_to_upsert[BATCH_SIZE:]
+                logger.debug("Subiendo lote de %d vectores a Pinecone.", len(batch))
+                await upsert(batch)
+
+        # Subir vectores restantes (lote final)
+        if vectors_to_upsert:
+            logger.debug("Subiendo lote final de %d vectores restantes.", len(vectors_to_upsert))
+            await upsert(vectors_to_upsert)
+
+        await asyncio.gather(*tasks)
+
+    try:
+        if batch_embedder:
+            await batch_embedder.resume_pending()
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_parse_worker) as executor:
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(parse_stage(executor))
+                stages.create_task(embed_stage())
+                stages.create_task(upsert_stage())
+    finally:
+        await client.close()
+        cache.close()
+        checkpoint.close()
+        manifest_log.close()
+
+    # Vectores de archivos modificados o eliminados que ya no pertenecen a ningún archivo actual
+    current_ids = {vector_id for entry in new_manifest.values() for vector_id in entry["ids"]}
+    stale_ids = sorted(known_ids - current_ids)
+    if stale_ids:
+        logger.info("Eliminando %d vectores de documentos modificados o eliminados...", len(stale_ids))
+        try:
+            delete_vectors(pinecone_index, stale_ids)
         except Exception as e:
-            print(f"Error al subir lote final a Pinecone: {e}")
+            # Sin compactar el manifiesto, la próxima ejecución vuelve a calcular y borrar estos IDs
+            logger.error("Error al eliminar vectores obsoletos de Pinecone: %s", e)
+            stats["incomplete"] = True
+            return stats
+        stats["deleted"] = len(stale_ids)
+        # Quitarlos del checkpoint para que vuelvan a subirse si el mismo contenido reaparece
+        remaining_ids = load_processed_ids(PROCESSED_IDS_PATH).difference(stale_ids)
+        with open(PROCESSED_IDS_PATH, "w", encoding="utf-8") as f:
+            f.write("".join(f"{vector_id}\n" for vector_id in remaining_ids))
 
-    print("\n--------------------------------------------------")
-    print(f"Indesación completada. Total de vectores procesados y subidos: {total_vectors}")
-    print("--------------------------------------------------")
+    prune_parsed_chunks({entry["sha256"] for entry in new_manifest.values()})
+    compact_manifest(MANIFEST_PATH, new_manifest)
+    return stats
+
+
+def index_data_optimized(directory: str, force_reindex: bool = False):
+    """Procesa documentos de forma optimizada, generando embeddings y subiendo a Pinecone."""
+    logger.info("Comenzando la indexación optimizada y subida a Pinecone...")
+
+    try:
+        # Inicialización de clientes
+        pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY")) 
+        openai_api_key = os.environ.get("OPENAI_API_KEY")
+        
+        logger.debug("Cliente de Pinecone inicializado.")
+
+        # Inicializar el índice (asumiendo que existe)
+        pinecone_index = pc.Index(INDEX_NAME)
+
+    except Exception as e:
+        logger.error("Error de inicialización de clientes: %s", e)
+        return None
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if force_reindex:
+            # Índice vacío y se vuelve a subir todo: elimina también cualquier vector ajeno al manifiesto
+            logger.info("--force-reindex: eliminando todos los vectores del índice...")
+            pinecone_index.delete(delete_all=True, namespace="")
+            with open(LEGACY_CLEANUP_PATH, "w", encoding="utf-8") as f:
+                f.write("delete_all\n")
+        elif not os.path.exists(LEGACY_CLEANUP_PATH):
+            delete_legacy_vectors(pinecone_index)
+    except Exception as e:
+        # Se reintenta en la próxima ejecución; --force-reindex los elimina en cualquier tipo de índice
+        logger.warning("Advertencia: No se pudieron eliminar los vectores del esquema anterior: %s", e)
+
+    stats = asyncio.run(run_indexing_pipeline(directory, pinecone_index, openai_api_key, force_reindex))
+
+    logger.info("\n--------------------------------------------------")
+    logger.info(
+        "Documentos procesados: %d (%d sin cambios). Chunks: %d (%d embeddings desde caché, %d duplicados, %d ya indexados).",
+        stats['documents'], stats['unchanged'], stats['chunks'], stats['cache_hits'], stats['duplicates'], stats['skipped']
+    )
+    logger.info("Indesación completada. Total de vectores procesados y subidos: %d (%d obsoletos eliminados).", stats['vectors'], stats['deleted'])
+    logger.info("--------------------------------------------------")
+    return stats
 
 
 if __name__ == "__main__":
-    print("\nINICIANDO PROCESO DE INDEXACIÓN")
+    parser = argparse.ArgumentParser(description="Descarga los documentos legales y los indexa en Pinecone.")
+    parser.add_argument(
+        "--force-reindex", action="store_true",
+        help="Vacía el índice de Pinecone y vuelve a generar y subir todos los chunks, ignorando el checkpoint."
+    )
+    args = parser.parse_args()
+
+    logger.info("\nINICIANDO PROCESO DE INDEXACIÓN")
+
+    zip_version = remote_zip_version(DATA_URL)
 
-    if not download_and_extract_data(DATA_URL, TEMP_DATA_DIR):
-        print("PROCESO FALLIDO: No se pudieron descargar y extraer los datos.")
+    if not args.force_reindex and zip_version and zip_version == read_indexed_zip_version():
+        # Mismo ZIP que la última indexación completa: no hace falta descargar ni generar embeddings
+        logger.info("Cache hit: el ZIP no cambió desde la última indexación (%s). Se omite la descarga.", zip_version)
+    elif not download_and_extract_data(DATA_URL, TEMP_DATA_DIR):
+        logger.error("PROCESO FALLIDO: No se pudieron descargar y extraer los datos.")
     else:
-        index_data_optimized(TEMP_DATA_DIR)
+        stats = index_data_optimized(TEMP_DATA_DIR, args.force_reindex)
+        # Registrar la versión solo si se subieron todos los chunks, sin archivos fallidos ni vectores obsoletos
+        # pendientes de borrar, para reintentarlos en la próxima ejecución
+        complete = stats and not stats["incomplete"] and stats["vectors"] + stats["skipped"] == stats["chunks"]
+        if zip_version and complete:
+            write_indexed_zip_version(zip_version)
 
-    print("Iniciando limpieza de archivos temporales...")
+    logger.info("Iniciando limpieza de archivos temporales...")
     if os.path.exists(TEMP_DATA_DIR):
         try:
             shutil.rmtree(TEMP_DATA_DIR)
-            print("Limpieza completada. Directorio temporal eliminado.")
+            logger.info("Limpieza completada. Directorio temporal eliminado.")
         except Exception as e:
-            print(f"Advertencia: No se pudo eliminar el directorio temporal: {e}")
+            logger.warning("Advertencia: No se pudo eliminar el directorio temporal: %s", e)
 
-    print("\nPROCESO FINALIZADO")
+    logger.info("\nPROCESO FINALIZADO")
@@ -0,0 +1,60 @@
+import asyncio
+import importlib
+import sys
+import types
+
+import httpx
+import pytest
+
+
+class FakeEmbeddings:
+    """Sustituye a AsyncOpenAI().embeddings: registra cada llamada y devuelve un vector por texto."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, input, model):
+        self.calls.append(list(input))
+        await asyncio.sleep(0)
+        return types.SimpleNamespace(
+            data=[types.SimpleNamespace(index=i, embedding=[float(i + 1), 1.0]) for i in range(len(input))]
+        )
+
+
+@pytest.fixture
+def api(monkeypatch):
+    for name in ("PINECONE_API_KEY", "OPENAI_API_KEY", "RECAPTCHA_SECRET_KEY", "PINECONE_ENVIRONMENT", "SENDGRID_API_KEY"):
+        monkeypatch.setenv(name, "test")
+
+    # Sin red: el índice de Pinecone falso devuelve siempre una respuesta sin coincidencias
+    class FakePinecone:
+        def __init__(self, **kwargs):
+            pass
+
+        def Index(self, name):
+            return types.SimpleNamespace(query=lambda **kwargs: types.SimpleNamespace(matches=[]))
+
+    monkeypatch.setattr("pinecone.Pinecone", FakePinecone)
+    sys.modules.pop("api", None)
+    module = importlib.import_module("api")
+    monkeypatch.setattr(module, "async_openai_client", types.SimpleNamespace(embeddings=FakeEmbeddings()))
+    monkeypatch.setattr(module, "generate_final_response", lambda query, context, history: f"Respuesta: {query}")
+    yield module
+    sys.modules.pop("api", None)
+
+
+def test_concurrent_queries_share_one_embeddings_call(api):
+    async def run():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.post("/query", json={"question": question, "recaptcha_token": "EsteEsUnTokenDePruebaTemporal"})
+                for question in ("¿Cómo tramito un divorcio?", "¿Qué pensión de alimentos corresponde a mi hijo?")
+            ))
+
+    responses = asyncio.run(run())
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert api.async_openai_client.embeddings.calls == [
+        ["¿cómo tramito un divorcio?", "¿qué pensión de alimentos corresponde a mi hijo?"]
+    ]
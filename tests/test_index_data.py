@@ -0,0 +1,98 @@
+import random
+import re
+
+import pytest
+
+import index_data
+
+
+class RegexEncoding:
+    """
+    Tokenizador determinista para las pruebas: cada palabra, signo y tramo de espacios es un token.
+    Como tiktoken, cuenta los separadores ("\\n\\n", " ") como tokens propios.
+    """
+
+    TOKEN = re.compile(r"\s+|\w+|[^\w\s]")
+
+    def encode_ordinary(self, text):
+        return self.TOKEN.findall(text)
+
+    def encode(self, text):
+        return self.encode_ordinary(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+def tiktoken_encoding():
+    try:
+        return index_data.tiktoken.encoding_for_model(index_data.EMBEDDING_MODEL)
+    except Exception as e:  # Sin red no se puede descargar el BPE
+        pytest.skip(f"tiktoken no disponible: {e}")
+
+
+@pytest.fixture(params=["regex", "tiktoken"])
+def encoding(request, monkeypatch):
+    enc = RegexEncoding() if request.param == "regex" else tiktoken_encoding()
+    monkeypatch.setattr(index_data, "_chunk_encoding", enc)
+    return enc
+
+
+def random_document(rng):
+    paragraphs = []
+    for _ in range(rng.randint(1, 6)):
+        lines = []
+        for _ in range(rng.randint(1, 4)):
+            words = [rng.choice(["artículo", "ley", "contrato", "cónyuge", "herencia", "de", "la", "el"]) for _ in range(rng.randint(1, 150))]
+            lines.append(". ".join(" ".join(words[i:i + 12]) for i in range(0, len(words), 12)))
+        paragraphs.append("\n".join(lines))
+    return "\n\n".join(paragraphs)
+
+
+def test_chunks_never_exceed_max_tokens(encoding):
+    rng = random.Random(7)
+    for _ in range(100):
+        texts = [random_document(rng) for _ in range(rng.randint(1, 3))]
+        for chunk in index_data.resize_chunks(texts):
+            assert len(encoding.encode(chunk)) <= index_data.CHUNK_MAX_TOKENS
+
+
+def test_merged_chunk_does_not_repeat_overlap(encoding):
+    paragraph = " ".join(f"palabra{i}" for i in range(170))
+    chunks = index_data.resize_chunks(["Primer párrafo corto.\n\n" + paragraph])
+    assert sum(chunk.count("Primer párrafo corto.") for chunk in chunks) == 1
+
+
+class Element:
+    def __init__(self, category, text):
+        self.category = category
+        self.text = text
+
+
+def test_split_on_titles_starts_a_section_at_each_title():
+    elements = [
+        Element("NarrativeText", "Preámbulo."),
+        Element("Title", "CAPÍTULO I"),
+        Element("NarrativeText", "Disposiciones generales."),
+        Element("NarrativeText", ""),
+        Element("Title", "CAPÍTULO II"),
+        Element("ListItem", "Primera obligación."),
+    ]
+    assert index_data.split_on_titles(elements) == [
+        "Preámbulo.",
+        "CAPÍTULO I\n\nDisposiciones generales.",
+        "CAPÍTULO II\n\nPrimera obligación.",
+    ]
+
+
+class RetryState:
+    def __init__(self, retry_after):
+        response = type("Response", (), {"headers": {"retry-after": retry_after}})()
+        exception = type("RateLimit", (Exception,), {"response": response})()
+        self.outcome = type("Outcome", (), {"exception": lambda _: exception})()
+        self.attempt_number = 1
+
+
+def test_wait_retry_after_is_capped():
+    assert index_data.wait_retry_after(RetryState("3")) == 3.0
+    assert index_data.wait_retry_after(RetryState("3600")) == index_data.RETRY_AFTER_MAX_SECONDS